@@ -2,7 +2,7 @@
 
 ####################################################################################################
 # This script downloads Python packages and their dependencies specified in a requirements.txt file.
-# It can automatically detect whether your system uses pip or pip3, and utilizes the appropriate command.
+# It runs pip through the current Python interpreter, so the pip used always matches the running Python.
 # It requires a Python version, a list of platforms and a directory to download the packages to be specified by the user.
 # It downloads both the default packages (Cython, wheel, setuptools) and those specified in the requirements.txt file.
 # The script also checks the existence of the requirements file and raises an error if it is not found.
@@ -20,121 +20,324 @@
 # The script can also print out current system information, including platform, 
 # Python version, pip version, and an example command to execute the script.
 # 
-# The script requires Python 3.6 or higher.
+# The script requires Python 3.8 or higher.
 # May also require package 'packaging' to be installed.
 #
 ####################################################################################################
 
 import os
+import pathlib
 import subprocess
 import glob
 import argparse
-import pip
 import sys
 import platform
+import threading
+import concurrent.futures
+import importlib.metadata
+import functools
+import itertools
+import atexit
+import tempfile
 from packaging import tags as otags
+from packaging.requirements import Requirement, InvalidRequirement
+from packaging.utils import canonicalize_name, parse_wheel_filename, InvalidWheelFilename
+
+
+# Serializes writes to the shared download_errors.log handle when packages are downloaded in parallel.
+log_lock = threading.Lock()
+# Opened on the first failure, so the file only exists if something failed.
+error_log = None
+
+# pip arguments shared by every download command
+_DOWNLOAD_PREFIX = ('download', '--quiet')
+_ONLY_BINARY = ('--only-binary=:all:',)
+_PYTHON_VERSION = '--python-version'
+_PLATFORM = '--platform'
+_ABI = '--abi'
 
 
 def get_pip_command():
     """
-    Get the pip command to use. If pip is not found, try pip3.
-    If neither is found, raise an exception.
+    Get the pip command to use. Runs pip as a module of the current interpreter,
+    which avoids probing for pip or pip3 executables on the PATH.
 
     Returns:
-        str: The pip command to use.
+        list: The pip command to use.
     """
-    try:
-        subprocess.check_call(['pip', '--version'])
-        return 'pip'
-    except FileNotFoundError:
-        pass
+    return [sys.executable, '-m', 'pip']
 
-    try:
-        subprocess.check_call(['pip3', '--version'])
-        return 'pip3'
-    except FileNotFoundError:
-        raise Exception("Neither pip nor pip3 was found on this system.")
-    
 
 def read_tags_and_versions(tags_file='system.tags'):
     """
     Read system tags from file and convert interpreters into version numbers.
+    The parsed tags are cached until the file's modification time changes. The cache only lives
+    for the current process, so it helps callers that import this module, not separate CLI runs.
 
     Returns:
-        list: List of system tags as (version, abi, platform) tuples.
+        tuple: System tags as (version, abi, platform) tuples.
     """
     try:
-        with open(tags_file, 'r') as f:
-            lines = [line.strip() for line in f.readlines()]
-            tags = []
-            for line in lines:
-                parts = line.split('-')
-                if len(parts) == 3:
-                    interpreter, abi, platform = parts
-                    if interpreter.startswith("cp") or interpreter.startswith("py"):
-                        version = interpreter[2:]
-                    else:
-                        raise ValueError(f"Unexpected interpreter format: {interpreter}")
-                    tags.append((version, abi, platform))
-                else:
-                    print(f"Failed to parse line {line} as a tag.")
-            return tags
+        mtime = os.path.getmtime(tags_file)
     except FileNotFoundError:
         print("System tags file not found. Please run with -i flag first to generate it.")
         sys.exit(1)
+    return _parse_tags_file(tags_file, mtime)
+
+
+@functools.lru_cache(maxsize=4)
+def _parse_tags_file(tags_file, mtime):
+    """
+    Parse a system tags file. The mtime argument is only used as part of the cache key.
+
+    Returns:
+        tuple: System tags as (version, abi, platform) tuples.
+    """
+    try:
+        tags = []
+        with open(tags_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                parts = line.split('-', 2)
+                if len(parts) != 3:
+                    print(f"Failed to parse line {line} as a tag.")
+                    continue
+                interpreter, abi, plat = parts
+                if not (interpreter.startswith("cp") or interpreter.startswith("py")):
+                    raise ValueError(f"Unexpected interpreter format: {interpreter}")
+                tags.append((interpreter[2:], abi, plat))
+        # Drop duplicate lines so a noisy tags file doesn't produce duplicate pip arguments
+        return tuple(dict.fromkeys(tags))
     except Exception as e:
         print(f"Failed to read system tags. Error: {e}")
         sys.exit(1)
 
 
-def download_package(package, tags, pip_command, download_folder):
+def _group_by_version(tags):
+    """
+    Collect the abis and platforms of the system tags for each python version.
+
+    Returns:
+        dict: Python versions mapped to (abis, platforms) tuples.
     """
-    Attempt to download the package for each tag. If unsuccessful, log the error and continue.
+    # Dicts are used as ordered sets so the tag priority from system.tags is kept.
+    groups = {}
+    for version, abi, plat in tags:
+        abis, platforms = groups.setdefault(version, ({}, {}))
+        abis[abi] = None
+        platforms[plat] = None
+    return groups
+
+
+def group_tags(tags):
+    """
+    Group system tags by python version. pip accepts repeated --platform and --abi flags
+    and will pick the best compatible wheel itself, so one invocation per version is enough.
 
     Args:
-        package (str): Name of the package to download.
-        tags (list): List of system tags as (version, abi, platform) tuples.
-        pip_command (str): Command for pip.
-        download_folder (str): Directory to download the packages to.
+        tags (tuple): System tags as (version, abi, platform) tuples.
+
+    Returns:
+        list: One list of pip tag arguments per python version.
+    """
+    tag_groups = []
+    for version, (abis, platforms) in _group_by_version(tags).items():
+        args = [_PYTHON_VERSION, version]
+        for plat in platforms:
+            args.extend((_PLATFORM, plat))
+        for abi in abis:
+            args.extend((_ABI, abi))
+        tag_groups.append(args)
+    return tag_groups
+
+
+def iter_requirements(requirements_file):
     """
-    for tag in tags:
-        version, abi, platform = tag
-        command = [
-            pip_command, 'download',
-            package,
-            '--python-version', version,
-            '--platform', platform,
-            '--abi', abi,
-            '--only-binary=:all:',
-            '-d', download_folder,
-        ]
+    Lazily read the requirements from a requirements.txt file, skipping blank and comment lines
+    which pip would otherwise reject.
+
+    Args:
+        requirements_file (str): Path to the requirements.txt file.
+
+    Yields:
+        str: Each requirement line, stripped of surrounding whitespace.
+    """
+    with open(requirements_file, 'r') as req_file:
+        for line in req_file:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield line
+
+
+def get_supported_tags(system_tags):
+    """
+    Expand the system tags into every wheel tag pip would accept for them, including
+    the abi3, none and pure python (e.g. py3-none-any) variants.
+
+    Args:
+        system_tags (tuple): System tags as (version, abi, platform) tuples.
+
+    Versions that aren't plain digits (e.g. from a compressed py2.py3 tag) are left out, so
+    nothing is skipped for them and pip handles them as usual.
+
+    Returns:
+        frozenset: packaging.tags.Tag objects compatible with the system tags.
+    """
+    supported = set()
+    for version, (abis, platforms) in _group_by_version(system_tags).items():
         try:
-            subprocess.check_call(command)
+            python_version = (int(version[0]), int(version[1:])) if len(version) > 1 else (int(version),)
+        except ValueError:
+            continue
+        supported.update(otags.cpython_tags(python_version, list(abis), list(platforms)))
+        supported.update(otags.compatible_tags(python_version, f"cp{version}", list(platforms)))
+    return frozenset(supported)
+
+
+def get_existing_wheels(download_folder):
+    """
+    Index the wheels already present in the download folder from a previous run.
+
+    Args:
+        download_folder (str): Directory the packages are downloaded to.
+
+    Returns:
+        dict: Canonicalized package names mapped to a list of (version, tags) tuples already downloaded.
+    """
+    existing = {}
+    for wheel in glob.glob(os.path.join(download_folder, '*.whl')):
+        try:
+            name, version, _, wheel_tags = parse_wheel_filename(os.path.basename(wheel))
+        except InvalidWheelFilename:
+            continue
+        existing.setdefault(name, []).append((version, wheel_tags))
+    return existing
+
+
+def is_already_downloaded(package, existing, supported_tags):
+    """
+    Check whether a requirement is already satisfied by a downloaded wheel built for the system tags.
+
+    Args:
+        package (str): Requirement line for the package.
+        existing (dict): Index of downloaded wheels, as returned by get_existing_wheels.
+        supported_tags (frozenset): Wheel tags for the system tags, as returned by get_supported_tags.
+
+    Returns:
+        bool: True if a compatible downloaded wheel satisfies the requirement.
+    """
+    try:
+        req = Requirement(package)
+    except InvalidRequirement:
+        return False  # Let pip deal with anything that isn't a plain requirement
+    if req.extras or req.url:
+        return False  # Extras pull in more dependencies, and a direct reference has no specifier to check
+    # Only allow prereleases when the specifier names one, like pip does. Passed explicitly since
+    # packaging 26 changed the default to accept them.
+    prereleases = bool(req.specifier.prereleases)
+    return any(
+        req.specifier.contains(version, prereleases=prereleases) and not supported_tags.isdisjoint(wheel_tags)
+        for version, wheel_tags in existing.get(canonicalize_name(req.name), ())
+    )
+
+
+def download_batch(packages, tag_groups, base_cmd):
+    """
+    Attempt to download all packages with a single pip invocation for the first tag group, so the
+    resolver only fetches dependencies shared between packages once.
+
+    Only the first group is tried: retrying the whole batch with a later python version would
+    download every package for that version, instead of each package's first compatible one.
+
+    Args:
+        packages (list): Names of the packages to download.
+        tag_groups (list): pip tag arguments for each python version, as returned by group_tags.
+        base_cmd (list): pip command for binary downloads, without the packages and tags.
+
+    Returns:
+        bool: True if binaries for every package were downloaded for the first tag group.
+    """
+    if not tag_groups:
+        return False
+
+    # Pass the packages through a temporary requirements file, a long requirements list
+    # on the command line can exceed the OS argument length limit.
+    with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as req_file:
+        req_file.write(''.join(f"{package}\n" for package in packages))
+    try:
+        command = base_cmd + tag_groups[0] + ['-r', req_file.name]
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=False)
+    finally:
+        os.unlink(req_file.name)
+
+    if result.returncode == 0:
+        return True
+
+    # Show why the batch failed, usually the package with no compatible wheel
+    lines = [line for line in result.stderr.decode(errors='replace').splitlines() if line.strip()]
+    errors = [line for line in lines if line.startswith('ERROR:')]
+    reason = errors[-1] if errors else (lines[-1] if lines else f"pip exited with code {result.returncode}")
+    print(f"Batched download failed: {reason}")
+    return False
+
+
+def log_error(message):
+    """
+    Append a line to download_errors.log. The file is opened on the first call and the
+    buffered handle is kept open for the rest of the run instead of reopening it per failure.
+
+    Args:
+        message (str): Line to write, without the trailing newline.
+    """
+    global error_log
+    with log_lock:
+        if error_log is None:
+            error_log = open('download_errors.log', 'a', buffering=8192)
+            atexit.register(error_log.close)
+        error_log.write(f"{message}\n")
+
+
+def download_package(package, tag_groups, base_cmd, fallback_cmd):
+    """
+    Attempt to download the package for each tag group. If unsuccessful, log the error and continue.
+
+    Args:
+        package (str): Name of the package to download.
+        tag_groups (list): pip tag arguments for each python version, as returned by group_tags.
+        base_cmd (list): pip command for binary downloads, without the package and tags.
+        fallback_cmd (list): pip command for source downloads, without the package.
+    """
+    for tag_args in tag_groups:
+        command = base_cmd + [package] + tag_args
+        result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=False)
+        if result.returncode == 0:
             return
-        except subprocess.CalledProcessError:
-            print(f"Failed to download binary for package {package} with tag {tag}, trying next tag.")
-            continue  # If package download failed, try the next tag
 
     # If failed to download binary, try to download source without tag filters
-    command = [pip_command, 'download', package, '-d', download_folder]
+    command = fallback_cmd + [package]
     try:
-        subprocess.check_call(command)
+        subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, check=True)
         return
-    except subprocess.CalledProcessError:
-        pass  # If still failed, log it and continue
+    except subprocess.CalledProcessError as e:
+        # If still failed, show pip's error output, log it and continue
+        print(f"Failed to download package {package}. pip output:\n{e.stderr.decode(errors='replace')}")
 
     # Log the failed package
-    with open('download_errors.log', 'a') as log_file:
-        log_file.write(f"Failed to download binary and source for package {package}.\n")
+    log_error(f"Failed to download binary and source for package {package}.")
 
 
-def download_packages(requirements_file, download_folder, tags_file='system.tags'):
+def download_packages(requirements_file, download_folder, tags_file='system.tags', jobs=4, pip_cache=None):
     """
     Download packages and dependencies specified in a requirements.txt file.
 
     Args:
         requirements_file (str): Path to the requirements.txt file.
         download_folder (str): Directory to download the packages to.
+        tags_file (str): Path to the system.tags file.
+        jobs (int): Number of packages to retry in parallel if the batched download fails.
+        pip_cache (str): Directory for pip's HTTP cache. If not specified, pip's default cache is used.
 
     Returns:
         None
@@ -142,19 +345,39 @@ def download_packages(requirements_file, download_folder, tags_file='system.tags
     pip_command = get_pip_command()
     default_packages = ["Cython", "wheel", "setuptools"]
 
-    # Read system tags and versions
+    # Read system tags and versions, and build the parts of the pip commands shared by every package
     system_tags = read_tags_and_versions(tags_file=tags_file)
+    tag_groups = group_tags(system_tags)
+    download_cmd = [*pip_command, *_DOWNLOAD_PREFIX]
+    if pip_cache:
+        # A persistent cache lets metadata and wheels fetched by one invocation be reused by retries and later runs
+        download_cmd += ['--cache-dir', pip_cache]
+    base_cmd = [*download_cmd, *_ONLY_BINARY, '-d', download_folder]
+    fallback_cmd = download_cmd + ['-d', download_folder]
+
+    # Download the default packages and those specified in the requirements file,
+    # skipping any that are already satisfied by a wheel from a previous run.
+    existing = get_existing_wheels(download_folder)
+    supported_tags = get_supported_tags(system_tags)
+    all_packages = [
+        package for package in itertools.chain(default_packages, iter_requirements(requirements_file))
+        if not is_already_downloaded(package, existing, supported_tags)
+    ]
+
+    if not all_packages:
+        return
 
-    for package in default_packages:
-        download_package(package, system_tags, pip_command, download_folder)
-
-    # Download packages specified in the requirements file.
-    with open(requirements_file, 'r') as req_file:
-        packages = req_file.readlines()
+    if download_batch(all_packages, tag_groups, base_cmd):
+        return
 
-    for package in packages:
-        package = package.strip()
-        download_package(package, system_tags, pip_command, download_folder)
+    # pip stops at the first package it can't satisfy, so retry each package on its own.
+    print("Retrying packages individually.")
+    # Each download is a pip subprocess doing network I/O, so threads are sufficient.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(
+            lambda package: download_package(package, tag_groups, base_cmd, fallback_cmd),
+            all_packages,
+        ))
 
 
 def create_local_requirements_file(download_folder):
@@ -168,11 +391,11 @@ def create_local_requirements_file(download_folder):
         None
     """
     try:
-        wheels = glob.glob(os.path.join(download_folder, '*.whl'))
-        with open('local_requirements.txt', 'w') as f:
-            for wheel in wheels:
-                line = './' + os.path.relpath(wheel) + '\n'
-                f.write(line)
+        # Resolve the relative path once rather than per wheel
+        prefix = os.path.relpath(download_folder)
+        prefix = './' if prefix == '.' else f'./{prefix}/'
+        with os.scandir(download_folder) as entries, open('local_requirements.txt', 'w', buffering=1 << 16) as f:
+            f.write(''.join(f'{prefix}{entry.name}\n' for entry in entries if entry.name.endswith('.whl')))
 
     except Exception as e:
         print(f"Failed to create local_requirements.txt file. Error: {e}")
@@ -190,7 +413,7 @@ def get_current_system_info():
     try:
         system_platform = platform.system().lower()
         python_version = "".join(map(str, sys.version_info[:2]))
-        pip_version = pip.__version__
+        pip_version = importlib.metadata.version('pip')
 
         print(f"Your current system information is:")
         print(f"Platform: {system_platform}")
@@ -204,19 +427,22 @@ def get_current_system_info():
         python_version_interpreter = f"cp{sys.version_info.major}{sys.version_info.minor}"
         python_version_abi = f"cp{sys.version_info.major}{sys.version_info.minor}m" if sys.version_info.major == 2 else f"cp{sys.version_info.major}{sys.version_info.minor}"
         system_arch = platform.machine()
-        filtered_tags = set()
+        filtered_tags = []
 
-        for tag in otags.sys_tags():
-            if (python_version_interpreter in str(tag) or python_version_abi in str(tag)) and system_arch in str(tag):
-                filtered_tags.add(tag)
+        # Compare the tag attributes directly rather than substring matching the whole tag string.
+        # sys_tags() never repeats a tag, so a list keeps them unique and in priority order.
+        want_interpreters = {python_version_interpreter, python_version_abi}
+        tags = tuple(otags.sys_tags())
+        for tag in tags:
+            if tag.interpreter in want_interpreters and system_arch in tag.platform:
+                filtered_tags.append(tag)
 
         print("Number of filtered tags found: ", len(filtered_tags))
 
         # Write tags to a file
         print("Attempting to write system tags to file system.tags...")
-        with open('system.tags', 'w') as f:
-            for tag in list(filtered_tags):
-                f.write(str(tag) + '\n')
+        with open('system.tags', 'w', buffering=1 << 16) as f:
+            f.write(''.join(f"{tag}\n" for tag in filtered_tags))
 
         print("Writing to file completed.")
 
@@ -237,6 +463,8 @@ def main():
     parser.add_argument('-d', '--directory', help='Directory to download the packages to.')
     parser.add_argument('-i', '--info', action='store_true', help='Get current system information, generate system.tags file, and print an example command for use.')
     parser.add_argument('-t', '--tags', help="Path to the system.tags file. If not specified, the 'system.tags' file in the current directory will be used.")
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of packages to retry in parallel, one pip call per package, if the batched download fails. Defaults to 4.')
+    parser.add_argument('--pip-cache', help="Directory for pip's HTTP cache, reused across runs. If not specified, pip's default cache is used.")
 
     args = parser.parse_args()
 
@@ -246,19 +474,28 @@ def main():
 
     if not all([args.requirements, args.directory]):
         parser.error("The -r, and -d options are required unless using the -i option.")
+
+    if args.jobs < 1:
+        parser.error("The -j option must be at least 1.")
     
     # Validate that the requirements file exists
     if not os.path.isfile(args.requirements):
         parser.error(f"The file {args.requirements} does not exist.")
 
-    os.makedirs(args.directory, exist_ok=True)
+    # Resolve the download folder once so pip doesn't re-resolve a relative path in every subprocess
+    download_folder = os.path.abspath(args.directory)
+    pathlib.Path(download_folder).mkdir(parents=True, exist_ok=True)
 
     if args.tags:
         tags_file = 'system.tags' if not args.tags else args.tags
         if not os.path.isfile(tags_file):
             parser.error(f"The file {tags_file} does not exist.")
-    download_packages(args.requirements, args.directory)
-    create_local_requirements_file(args.directory)
+
+    download_packages(
+        args.requirements, download_folder,
+        tags_file=args.tags or 'system.tags', jobs=args.jobs, pip_cache=args.pip_cache,
+    )
+    create_local_requirements_file(download_folder)
     print(f"Successfully downloaded packages to {args.directory}.")
     print("Example usage to perform installation of local packages:")
     print(f"\tpip install -r requirements.txt --find-links {args.directory} --no-index")